@@ -1,4 +1,4 @@
-import re
+import math
 import warnings
 import torch
 import numpy as np
@@ -6,6 +6,8 @@ import numpy.typing as npt
 import random as rd
 
 from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from typing import Union, Optional, Dict, List, Tuple
 
@@ -14,7 +16,6 @@ from torch_geometric.loader import DataLoader
 
 from e3nn import o3
 from e3nn.nn import FullyConnectedNet
-from e3nn.math import soft_one_hot_linspace
 from e3nn.util.jit import script, trace, compile_mode, compile
 
 from sklearn.model_selection import train_test_split
@@ -96,6 +97,23 @@ class PAO_Object:
         self.xblock = xblock
         U, S, Vh = torch.linalg.svd(xblock, full_matrices=False)
         self.label = Vh
+        self.label_projector = Vh.T @ Vh
+        # One node per neighbour so that the collated Batch.batch maps every neighbour to its sample,
+        # the center and label projector carry a leading sample dimension to collate to (batch_size, ...)
+        self.data = Data(x=center.unsqueeze(dim=0), pos=coords, y=self.label,
+                         y_proj=self.label_projector.unsqueeze(dim=0), z=atomkind, num_nodes=coords.shape[0])
+
+
+# ======================================================================================
+@torch.jit.script
+def radial_embedding(edge_vec: torch.Tensor, max_radius: float, number: int) -> torch.Tensor:
+    r"""Cosine radial basis with cutoff of the neighbour distances, normalized by sqrt(number). Fused equivalent of
+    soft_one_hot_linspace(edge_vec.norm(dim=1), 0.0, max_radius, number, basis='cosine', cutoff=True).mul(number**0.5)
+    """
+    values = torch.linspace(0.0, max_radius, number + 2, dtype=edge_vec.dtype, device=edge_vec.device)
+    step = values[1] - values[0]
+    diff = (torch.linalg.vector_norm(edge_vec, dim=1).unsqueeze(-1) - values[1:-1]) / step
+    return torch.cos(math.pi / 2 * diff) * ((diff > -1) & (diff < 1)) * number**0.5
 
 
 # Torch Module for PAO learning
@@ -111,7 +129,8 @@ class PAO_model(torch.nn.Module):
                  prim_basis_size: int,
                  irreps_input: o3.Irreps,
                  irreps_sh: o3.Irreps,
-                 irreps_output: o3.Irreps):
+                 irreps_output: o3.Irreps,
+                 compile_forward: bool = False):
         super().__init__()
         change_of_coord = t([
             [0., 0., 1.],
@@ -128,11 +147,19 @@ class PAO_model(torch.nn.Module):
         self.irreps_input = irreps_input
         self.irreps_sh = irreps_sh
         self.irreps_output = irreps_output
+        self.compile_forward = compile_forward
+        self._compiled_forward = None
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+        if prim_basis_spec.dim > 32:
+            warnings.warn(f"Primitive basis of dimension {prim_basis_spec.dim} exceeds 32, the batched eigensolver "
+                          "of the auxiliary Hamiltonian falls back to a considerably slower code path on CUDA.",
+                          RuntimeWarning)
+
         irreps_mid = o3.Irreps([(5, (l, (-1)**l)) for l in range(prim_basis_spec.lmax+1)])
         self.irreps_mid = irreps_mid
         
+        self.sh = o3.SphericalHarmonics(irreps_sh, normalize=True, normalization='component')
         #self.lin1 = o3.Linear(irreps_sh, irreps_sh)
         self.tp =  o3.FullyConnectedTensorProduct(irreps_input, irreps_sh, irreps_mid, shared_weights=False)
         #self.lin2 = o3.Linear(irreps_mid, irreps_mid)
@@ -140,126 +167,97 @@ class PAO_model(torch.nn.Module):
         
         self.num_layers = num_layers
         self.fc = FullyConnectedNet([self.num_distances, num_layers, self.tp.weight_numel], torch.nn.functional.silu)
-        self.coord_change = self.tp_out.irreps_out.D_from_matrix(change_of_coord).to(self.device)
-
-        idx_in = []
-        aux_H_idx_in = 2*t(prim_basis_spec.ls)+1 
-        self.wigner_dict = {}
-
-        for idx, mu_i in enumerate(prim_basis_spec.ls):
-            # Spherical Harmonic Factor 2
-            for jdx, mu_j in enumerate(prim_basis_spec.ls[idx:]):
-                # Contraction contribution of Spherical Harmonic with L={|L1-L2|...L1+L2}
-                for mu_ij in range(abs(mu_i-mu_j),mu_i+mu_j+1):
-                    # Check parity (even*even=even, odd*odd=even, even*odd=odd) and generate wigner matrix only for match
-                    if mu_i%2==mu_j%2 and mu_ij%2==0 or mu_i%2!=mu_j%2 and mu_ij%2==1:
-                        idx_in.append(2*mu_ij+1)
-                        wigner_m = o3.wigner_3j(mu_i, mu_j, mu_ij)
-                        wig_zero_factor = wigner_m[(2*mu_i+1)//2,(2*mu_j+1)//2,(2*mu_ij+1)//2]
-                        wigner_m = wig_zero_factor*wigner_m
-                        self.wigner_dict[f"{mu_i}{mu_j}{mu_ij}"] = wigner_m.clone().to(self.device)
-
-        idx_in = t(idx_in)
-        self.idx_out = torch.cumsum(idx_in, dim=0, dtype=int)              # rh-index into pred-vector
-        self.aux_H_idx_out = torch.cumsum(aux_H_idx_in, dim=0, dtype=int)    # rh-index into auxiliary Hamiltonian
-        self.idx_in = self.idx_out-idx_in                                    # lh-index of pred-vector
-        self.aux_H_idx_in = self.aux_H_idx_out-aux_H_idx_in                  # lh-index into auxiliary Hamiltonian
+        self.register_buffer("coord_change", self.tp_out.irreps_out.D_from_matrix(change_of_coord).to(self.device))
+
+        pred_dims = []
+        aux_H_dims = 2*t(prim_basis_spec.ls)+1 
+        shell_couplings = []
+
+        for idx, jdx, mu_i, mu_j, mu_ij in shell_triples(prim_basis_spec):
+            pred_dims.append(2*mu_ij+1)
+            shell_couplings.append((idx, jdx, wigner_coupling_block(mu_i, mu_j, mu_ij, torch.get_default_dtype())))
+
+        pred_dims = t(pred_dims)
+        idx_out = torch.cumsum(pred_dims, dim=0, dtype=int)                # rh-index into pred-vector
+        aux_H_idx_out = torch.cumsum(aux_H_dims, dim=0, dtype=int)         # rh-index into auxiliary Hamiltonian
+        idx_in = idx_out-pred_dims                                         # lh-index of pred-vector
+        aux_H_idx_in = aux_H_idx_out-aux_H_dims                            # lh-index into auxiliary Hamiltonian
+
+        # Coupling tensor W[a,b,p] mapping the pred-vector (p) onto the auxiliary Hamiltonian (a,b),
+        # so that the whole auxiliary Hamiltonian is built by a single contraction
+        W_coupling = torch.zeros((prim_basis_spec.dim, prim_basis_spec.dim, int(idx_out[-1])))
+        for shell, (i, j, wigner_m) in enumerate(shell_couplings):
+            rows = slice(int(aux_H_idx_in[i]), int(aux_H_idx_out[i]))
+            cols = slice(int(aux_H_idx_in[j]), int(aux_H_idx_out[j]))
+            pred_slice = slice(int(idx_in[shell]), int(idx_out[shell]))
+            W_coupling[rows, cols, pred_slice] += wigner_m
+            if i != j: # also add transform of non-diagonal blocks
+                W_coupling[cols, rows, pred_slice] += torch.transpose(wigner_m, dim0=0, dim1=1)
+        self.register_buffer("W_coupling", W_coupling.to(self.device))
 
     def build_aux_H(self, pred):
-        aux_H = torch.zeros((self.prim_basis_spec.dim,self.prim_basis_spec.dim))        # auxiliary Hamiltonian
-        jdx_shift = 0
-
-        # Spherical Harmonic Factor 1
-        for idx, mu_i in enumerate(self.prim_basis_spec.ls):
-            # Spherical Harmonic Factor 2
-            for jdx, mu_j in enumerate(self.prim_basis_spec.ls[idx:]):
-                # Contraction contribution of Spherical Harmonic with L={|L1-L2|...L1+L2}
-                for mu_ij in range(abs(mu_i-mu_j),mu_i+mu_j+1):
-                    # Check parity (even*even=even, odd*odd=even, even*odd=odd) and calculate coefficients only for match
-                    if mu_i%2==mu_j%2 and mu_ij%2==0 or mu_i%2!=mu_j%2 and mu_ij%2==1:
-                        # Contraction per shell
-                        contraction_coefficients = torch.matmul(self.wigner_dict[f"{mu_i}{mu_j}{mu_ij}"], pred[self.idx_in[jdx_shift]:self.idx_out[jdx_shift]])
-                        # Add shell contribution to resp. block in the auxiliary Hamiltionan
-                        aux_H[self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx],self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx]] = \
-                        aux_H[self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx],self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx]]   \
-                        + contraction_coefficients 
-                        if idx!=idx+jdx: # also add transform of non-diagonal blocks
-                            aux_H[self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx],self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx]]\
-                            = aux_H[self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx],self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx]]\
-                            + contraction_coefficients.T 
-                        jdx_shift += 1
+        # auxiliary Hamiltonian of a single sample from one contraction with the Wigner coupling tensor
+        aux_H = torch.einsum('abp,p->ab', self.W_coupling, pred)
         return aux_H
 
-    def build_aux_H_batch(self, batch, pred):
-        aux_H = torch.zeros((batch, self.prim_basis_spec.dim,self.prim_basis_spec.dim), device=self.device)        # auxiliary Hamiltonian
-        jdx_shift = 0
-
-        # Spherical Harmonic Factor 1
-        for idx, mu_i in enumerate(self.prim_basis_spec.ls):
-            # Spherical Harmonic Factor 2
-            for jdx, mu_j in enumerate(self.prim_basis_spec.ls[idx:]):
-                # Contraction contribution of Spherical Harmonic with L={|L1-L2|...L1+L2}
-                for mu_ij in range(abs(mu_i-mu_j),mu_i+mu_j+1):
-                    # Check parity (even*even=even, odd*odd=even, even*odd=odd) and calculate coefficients only for match
-                    if mu_i%2==mu_j%2 and mu_ij%2==0 or mu_i%2!=mu_j%2 and mu_ij%2==1:
-                        # Contraction per shell
-                        wigner_m = self.wigner_dict[f"{mu_i}{mu_j}{mu_ij}"]
-                        pred_block = pred[:,self.idx_in[jdx_shift]:self.idx_out[jdx_shift]]
-
-                        # If possible, convert this to torch.einsum() notation
-                        contraction_coefficients = \
-                            torch.transpose(
-                                torch.transpose(
-                                torch.matmul(wigner_m, torch.transpose(pred_block, dim0=0, dim1=1)),
-                                dim0=0, dim1=2),
-                            dim0=1, dim1=2)                        
-                    
-                        # Add shell contribution to resp. block in the auxiliary Hamiltionan
-                        aux_H[:,self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx],self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx]] = \
-                        aux_H[:,self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx],self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx]]   \
-                        + contraction_coefficients 
-                        if idx!=idx+jdx: # also add transform of non-diagonal blocks
-                            aux_H[:,self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx],self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx]]\
-                            = aux_H[:,self.aux_H_idx_in[jdx+idx]:self.aux_H_idx_out[jdx+idx],self.aux_H_idx_in[idx]:self.aux_H_idx_out[idx]]\
-                            + torch.transpose(contraction_coefficients, dim0=1, dim1=2) 
-                        jdx_shift += 1
+    def build_aux_H_batch(self, pred):
+        # auxiliary Hamiltonian of all samples in the batch from one contraction with the Wigner coupling tensor
+        aux_H = torch.einsum('abp,np->nab', self.W_coupling, pred)
         return aux_H
 
     def forward(self, data: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        # Training optionally runs through torch.compile, export tracing always uses the eager implementation
+        if self.training and self.compile_forward and not torch.jit.is_tracing():
+            if self._compiled_forward is None:
+                self._compiled_forward = torch.compile(self._forward_impl, dynamic=False)
+            return self._compiled_forward(data)
+        return self._forward_impl(data)
+
+    def _forward_impl(self, data: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         edge_vec = data["pos"].to(self.device)
         central_atom = data["x"].to(self.device)
         atomkind = data["z"].to(self.device)
 
-        if len(edge_vec.shape) == 3:
+        flat_batch = "batch" in data
+        if flat_batch:
+            # Flattened neighbours of samples with varying neighbour counts, batch maps each neighbour to its sample
+            # (e.g. a torch_geometric Batch of PAO_Object.data)
+            batch = data["batch"].to(self.device)
+            central_atom = central_atom.reshape(-1, 3)
+            batch_size = central_atom.shape[0]
+            edge_vec = torch.sub(edge_vec, central_atom[batch])
+            f_in = atomkind
+
+        else:
+            if len(edge_vec.shape) == 2:
+                edge_vec = edge_vec.unsqueeze(dim=0)
+                central_atom = central_atom.unsqueeze(dim=0)
+                atomkind = atomkind.unsqueeze(dim=0)
             batch_size = edge_vec.shape[0]
             num_neighbors = edge_vec.shape[1]
-            n_edge_vec = edge_vec.shape[0]*edge_vec.shape[1]
-            central_atom = central_atom.unsqueeze(dim=1)
-
-        elif len(edge_vec.shape) == 2:
-            num_neighbors = edge_vec.shape[0]
-            batch_size = 1
-            n_edge_vec = num_neighbors
-            edge_vec = edge_vec.unsqueeze(dim=0)
-            central_atom = central_atom.unsqueeze(dim=0)
-            atomkind = atomkind.unsqueeze(dim=0)
-
-        edge_vec = torch.sub(edge_vec, central_atom)
-        edge_vec = edge_vec.reshape(n_edge_vec, 3)
-        f_in = atomkind.reshape(n_edge_vec, atomkind.shape[-1])
-        x = o3.spherical_harmonics(l=self.irreps_sh, x=edge_vec, normalize=True, normalization='component')
-        emb = soft_one_hot_linspace(x=edge_vec.norm(dim=1), start=0.0, end=self.max_radius, number=self.num_distances, 
-                                    basis='cosine', cutoff=True).mul(self.num_distances**0.5)
+            edge_vec = torch.sub(edge_vec, central_atom.unsqueeze(dim=1))
+            edge_vec = edge_vec.reshape(batch_size*num_neighbors, 3)
+            f_in = atomkind.reshape(batch_size*num_neighbors, atomkind.shape[-1])
+
+        x = self.sh(edge_vec)
+        emb = radial_embedding(edge_vec, float(self.max_radius), self.num_distances)
         #x = self.lin1(sh)
         aux_H = self.tp(f_in, x, self.fc(emb))
-        aux_H = aux_H.reshape((batch_size,aux_H.shape[0]//batch_size,aux_H.shape[1])).sum(dim=1).div(num_neighbors**0.5)
+        if flat_batch:
+            # Sum the neighbour contributions per sample and normalize by the number of neighbours of the sample
+            num_neighbors = torch.bincount(batch, minlength=batch_size).clamp(min=1).to(aux_H.dtype)
+            aux_H = torch.zeros((batch_size, aux_H.shape[1]), dtype=aux_H.dtype, device=aux_H.device).index_add_(0, batch, aux_H)
+            aux_H = aux_H.div(num_neighbors.sqrt().unsqueeze(dim=1))
+        else:
+            aux_H = aux_H.reshape((batch_size, num_neighbors, aux_H.shape[1])).sum(dim=1).div(num_neighbors**0.5)
         #aux_H = self.lin2(aux_H)
         aux_H = self.tp_out(aux_H, aux_H)
         aux_H = torch.matmul(aux_H, self.coord_change)
-        aux_H = self.build_aux_H_batch(batch_size, aux_H)
+        aux_H = self.build_aux_H_batch(aux_H)
 
         # Eigendecomposition of auxiliary hamiltonian to extract PAO basis vectors from eigenvectors
-        L, Q = torch.linalg.eigh(aux_H)
+        # aux_H is symmetric by construction, keep it contiguous and in its dtype to stay on the batched solver
+        L, Q = torch.linalg.eigh(aux_H.contiguous(), UPLO='U')
         pao_vectors = torch.transpose(Q[:,:,:self.pao_basis_size], dim0=1, dim1=2)
 
         data["pao_vectors"] = pao_vectors
@@ -339,9 +337,10 @@ class GradOutput(torch.nn.Module):
         for k in self.wrt:
             grad_outputs.append(torch.ones_like(data[self.of], device=self.device))
             
-        # Get grads
+        # Get grads, the graph is only kept alive in training where the loss is backpropagated afterwards
         grads = torch.autograd.grad(
-            inputs=wrt_tensors, outputs=[data[self.of],], grad_outputs=grad_outputs, retain_graph=True)
+            inputs=wrt_tensors, outputs=[data[self.of],], grad_outputs=grad_outputs,
+            retain_graph=self.training, create_graph=False)
         
         # return
         for out, grad in zip(self.out_field, grads):
@@ -370,9 +369,17 @@ def parse_pao_file(
     coords_list = []
     xblocks = []
 
-    for line in path.read_text().strip().split("\n"):
+    for line in path.read_text().splitlines():
+        if line.startswith("Xblock"):
+            # Parse the matrix elements in one call instead of converting every token separately
+            xblocks.append(np.fromstring(line.split(maxsplit=2)[2], dtype=np.float64, sep=" "))
+            continue
+
         parts = line.split()
-        if parts[0] == "Parametrization":
+        if not parts:
+            continue
+
+        elif parts[0] == "Parametrization":
             assert parts[1] == "EQUIVARIANT"
 
         elif parts[0] == "Kind":
@@ -397,9 +404,6 @@ def parse_pao_file(
             atom2kind.append(parts[2])
             coords_list.append(parts[3:])
 
-        elif parts[0] == "Xblock":
-            xblocks.append(np.array(parts[2:], float))
-
     # Convert coordinates to torch tensor.
     coords = np.array(coords_list, float)
 
@@ -426,9 +430,10 @@ def append_samples(
     coords: NDArray,
     xblocks: List[NDArray],
 ) -> None:
+    # Relative coordinates of all atoms w.r.t. every central atom in one broadcast, all_rel_coords[i] = coords - coords[i]
+    all_rel_coords = coords[None, :, :] - coords[:, None, :]
     for iatom, kind_name in enumerate(atom2kind):
-        rel_coords = coords - coords[iatom, :]
-        sample = PaoSample(rel_coords=rel_coords, xblock=xblocks[iatom])
+        sample = PaoSample(rel_coords=all_rel_coords[iatom], xblock=xblocks[iatom])
         if kind_name not in samples:
             samples[kind_name] = []
         samples[kind_name].append(sample)
@@ -470,23 +475,42 @@ def write_pao_file(
         assert len(xblocks[iatom].shape) == 2
         assert xblocks[iatom].shape[0] == kind.pao_basis_size
         assert xblocks[iatom].shape[1] == kind.prim_basis_size
-        x = xblocks[iatom].flatten()
-        y = " ".join(["%f" % i for i in x])
-        output.append(f"Xblock {iatom + 1} {y}")
 
-    output.append("THE_END")
-    path.write_text("\n".join(output))
+    # Write incrementally and let numpy format the Xblocks row-wise instead of joining one large string
+    with path.open("w") as f:
+        f.write("\n".join(output) + "\n")
+        for iatom in range(natoms):
+            f.write(f"Xblock {iatom + 1} ")
+            np.savetxt(f, xblocks[iatom].reshape(1, -1), fmt="%f")
+        f.write("THE_END")
 
 
 # ======================================================================================
-def read_cp2k_energy(path: Path) -> float:
+def read_cp2k_energy(path: Path, block_size: int = 1 << 20) -> float:
+    marker = b"ENERGY|"
     try:
-        content = path.read_text()
-        m = re.search(r"ENERGY\|(.*)", content)
-        assert m
-        return float(m.group(1).split()[-1])
+        # Search the raw bytes block-wise for the first energy line instead of decoding and regex-matching the whole
+        # output, blocks overlap by len(marker)-1 bytes so that a marker split across a block boundary is found
+        with path.open("rb") as f:
+            carry = b""
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                buf = carry + block
+                pos = buf.find(marker)
+                if pos >= 0:
+                    line = buf[pos + len(marker):]
+                    while b"\n" not in line:
+                        more = f.read(block_size)
+                        if not more:
+                            break
+                        line += more
+                    return float(line.split(b"\n", 1)[0].split()[-1])
+                carry = buf[-(len(marker) - 1):]
     except:
-        print(f"error with: {path}")
+        pass
+    print(f"error with: {path}")
     return float("NaN")
 
 
@@ -497,40 +521,74 @@ def convert_basis_name_to_irreps(
     pass
 
 
+# ======================================================================================
+@lru_cache(maxsize=None)
+def _one_hot_atomkinds(atomkinds: Tuple[KindName, ...], atomkind: Tuple[KindName, ...]) -> torch.Tensor:
+    kind_to_idx = {kind_name: i for i, kind_name in enumerate(atomkinds)}
+    kind_idxs = np.fromiter((kind_to_idx[k] for k in atomkind), dtype=np.int64, count=len(atomkind))
+    return torch.nn.functional.one_hot(torch.from_numpy(kind_idxs), num_classes=len(atomkinds)).to(torch.float32)
+
+
 # ======================================================================================
 def generate_f_in(atomkinds: Dict[KindName, AtomicKind], atomkind: List[KindName]) -> torch.Tensor:
-    r"""One-hot encoding of the atomtype
+    r"""One-hot encoding of the atomtype, memoized on the kinds and atom composition (e.g. for all frames of an MD run)
     """  
-    f_in = t([[k==j for j in atomkinds] for k in atomkind], dtype=torch.float32)
+    f_in = _one_hot_atomkinds(tuple(atomkinds), tuple(atomkind)).clone()
     return f_in
 
 
 # ======================================================================================
-def pao_objects_from_file(file_path: Path) -> List[PAO_Object]:
-    r"""PAO objects from CP2K PAO file
+def pao_objects_from_file(file_path: Path, kind: Optional[KindName] = None) -> List[PAO_Object]:
+    r"""PAO objects from CP2K PAO file, only for atoms of the given kind (atomic symbol) if provided
     """
     pao_objects = []
     kinds, atom2kind, coords, xblocks = parse_pao_file_torch(file_path)
+    f_in = generate_f_in(kinds, atom2kind)
+    atom_idxs = torch.arange(len(atom2kind))
     for idx, atom in enumerate(atom2kind):
-        idxs = list(range(len(atom2kind)))
-        idxs.pop(idx)
-        f_in = generate_f_in(kinds, atom2kind)
+        if kind is not None and atomic_symbols[kinds[atom].atomic_number] != kind:
+            continue
+        idxs = atom_idxs != idx
         pao_objects.append(PAO_Object(kinds[atom], f_in[idxs], coords[idx], coords[idxs], xblocks[idx]))
     return pao_objects
 
 
+# ======================================================================================
+@lru_cache(maxsize=None)
+def shell_triples(prim_basis_spec: o3.Irreps) -> Tuple[Tuple[int, int, int, int, int], ...]:
+    r"""Shell couplings contributing to the auxiliary Hamiltonian of the primitive basis set.
+
+    Returns the tuples (idx, jdx, l1, l2, l3) of the upper triangle of shell pairs idx <= jdx with angular
+    momenta l1, l2 coupled to L=l3, in the order of the prediction vector. Computed once per basis set.
+    """
+    triples = []
+    # Spherical Harmonic Factor 1
+    for idx, mu_i in enumerate(prim_basis_spec.ls):
+        # Spherical Harmonic Factor 2
+        for jdx, mu_j in enumerate(prim_basis_spec.ls[idx:], start=idx):
+            # Contraction contribution of Spherical Harmonic with L={|L1-L2|...L1+L2}
+            for mu_ij in range(abs(mu_i-mu_j),mu_i+mu_j+1):
+                # Check parity (even*even=even, odd*odd=even, even*odd=odd) and keep only matches
+                if mu_i%2==mu_j%2 and mu_ij%2==0 or mu_i%2!=mu_j%2 and mu_ij%2==1:
+                    triples.append((idx, jdx, mu_i, mu_j, mu_ij))
+    return tuple(triples)
+
+
+# ======================================================================================
+@lru_cache(maxsize=None)
+def wigner_coupling_block(l1: int, l2: int, l3: int, dtype: torch.dtype) -> torch.Tensor:
+    r"""Wigner 3j matrix coupling l1 and l2 to l3, scaled by its central (m1=m2=m3=0) element. Computed once per triple
+    and dtype and shared by all models, the returned tensor must not be modified in place.
+    """
+    wigner_m = o3.wigner_3j(l1, l2, l3, dtype=dtype)
+    wig_zero_factor = wigner_m[(2*l1+1)//2,(2*l2+1)//2,(2*l3+1)//2]
+    return wig_zero_factor*wigner_m
+
+
 # ======================================================================================
 def irreps_output_from_prim_basis(prim_basis_specs: o3.Irreps) -> o3.Irreps:
     r"""Irreducible representations required to build the auxiliary Hamiltonian based on the composition of the primitive basis set"""
-    all_ir = o3.Irreps()
-    for idx, l1 in enumerate(prim_basis_specs.ls):
-        irrep1=o3.Irrep(l1, (-1)**l1)
-        for l2 in prim_basis_specs.ls[idx:]:
-            irrep2=o3.Irrep(l2, (-1)**l2)
-            mul = irrep1*irrep2
-            for ir in mul:
-                if ir.l%2==0 and ir.p==1 or ir.l%2==1 and ir.p==-1:
-                    all_ir += ir
+    all_ir = o3.Irreps([(1, (l3, (-1)**l3)) for _, _, _, _, l3 in shell_triples(prim_basis_specs)])
     return all_ir.simplify()
 
 
@@ -543,13 +601,19 @@ def irreps_input_from_pao_object(pao_object: PAO_Object) -> o3.Irreps:
 
 
 # ======================================================================================
-def loss_function_ortho_projector_batch(pred, label):
+@torch.jit.script
+def loss_function_projector_batch(pred: torch.Tensor, label_projector: torch.Tensor) -> torch.Tensor:
+    r"""Loss function for batch learning based on the projection matrix of the predicted vectors and the precomputed
+    projection matrix of the label vectors.
+    """
+    # Single expression so the TorchScript fuser can merge the residual, square and mean
+    return (torch.transpose(pred, 1, 2) @ pred - label_projector).pow(2).mean()
+
+@torch.jit.script
+def loss_function_ortho_projector_batch(pred: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
     r"""Loss function for batch learning based on projection matrices of two sets of vectors.
     """
-    pred_projector = torch.bmm(torch.transpose(pred, dim0=1, dim1=2), pred)
-    label_projector = torch.bmm(torch.transpose(label, dim0=1, dim1=2), label)
-    residual = pred_projector - label_projector
-    return residual.pow(2).mean()
+    return loss_function_projector_batch(pred, torch.transpose(label, 1, 2) @ label)
 
 def loss_function_ortho_projector(pred, label):
     r"""Loss function based on projection matrices of two sets of vectors.
@@ -561,18 +625,18 @@ def loss_function_ortho_projector(pred, label):
 
 
 # ======================================================================================
-def pao_objects_from_paths(paths: List[Path]) -> Dict[KindName, List[PAO_Object]]:
-    r"""Create PAO objects from PAO files at provided paths.
+def pao_objects_from_paths(paths: List[Path], kind: Optional[KindName] = None) -> Dict[KindName, List[PAO_Object]]:
+    r"""Create PAO objects from PAO files at provided paths, only for atoms of the given kind if provided.
     """
     pao_objects = {}
     for path in paths:
-        temp_pao_objects = pao_objects_from_file(path)
+        temp_pao_objects = pao_objects_from_file(path, kind)
         for pao_object in temp_pao_objects:
-            kind = atomic_symbols[pao_object.kind.atomic_number]
-            if kind not in pao_objects:
-                pao_objects[kind] = [pao_object]
+            symbol = atomic_symbols[pao_object.kind.atomic_number]
+            if symbol not in pao_objects:
+                pao_objects[symbol] = [pao_object]
             else:
-                pao_objects[kind].append(pao_object)
+                pao_objects[symbol].append(pao_object)
     return pao_objects
 
 
@@ -582,15 +646,11 @@ def generate_train_test_datasets(pao_objects: Dict[KindName, List[PAO_Object]],
     """
     datasets = {}
     for atomtype in pao_objects:
-        dataset = [Data(
-            x=pao_object.center,
-            pos=pao_object.coords,
-            y=pao_object.label,
-            z=pao_object.atomkind) for pao_object in pao_objects[atomtype]]
+        dataset = [pao_object.data for pao_object in pao_objects[atomtype]]
         train_data, test_data = train_test_split(dataset, test_size=test_size)
         datasets[atomtype] = {
-            "train": train_data.copy(),
-            "test": test_data.copy()
+            "train": train_data,
+            "test": test_data
             }
     return datasets
 
@@ -621,7 +681,7 @@ def generate_batched_dict(pao_objects, batch_size):
         batch_dict = {
                 "x": torch.stack([pao_objects[idx].center for idx in batch_idxs]),
                 "pos": torch.stack([pao_objects[idx].coords for idx in batch_idxs]),
-                "y": torch.stack([pao_objects[idx].label for idx in batch_idxs]),
+                "y_proj": torch.stack([pao_objects[idx].label_projector for idx in batch_idxs]),
                 "z": torch.stack([pao_objects[idx].atomkind for idx in batch_idxs])
         }
         batched_datadicts.append(batch_dict)
@@ -629,19 +689,26 @@ def generate_batched_dict(pao_objects, batch_size):
 
 
 # ======================================================================================
-def generate_train_dataloader(datasets: Dict[KindName, List[PAO_Object]], batch_size=32):
+def generate_train_dataloader(datasets: Dict[KindName, List[PAO_Object]], batch_size=32, num_workers=0):
     r"""Create dataloaders for training and validation from datasets.
+    Batches are collated in num_workers background processes and staged in pinned memory when training on GPU.
     """
     dataloaders = {}
     vdataloaders = {}
+    loader_options = {
+        "num_workers": num_workers,
+        "pin_memory": torch.cuda.is_available(),
+        "persistent_workers": num_workers > 0
+    }
     for atomtype in datasets:
-        dataloaders[atomtype] = DataLoader(datasets[atomtype]["train"], batch_size=batch_size, shuffle=True)
-        vdataloaders[atomtype] = DataLoader(datasets[atomtype]["test"], batch_size=batch_size, shuffle=True)
+        dataloaders[atomtype] = DataLoader(datasets[atomtype]["train"], batch_size=batch_size, shuffle=True, **loader_options)
+        vdataloaders[atomtype] = DataLoader(datasets[atomtype]["test"], batch_size=batch_size, shuffle=True, **loader_options)
     return dataloaders, vdataloaders
 
 
 # ======================================================================================
-def init_pao_models(pao_objects: Dict[KindName, List[PAO_Object]], cutoff, num_neighbors, num_layers=32, require_grad=True):
+def init_pao_models(pao_objects: Dict[KindName, List[PAO_Object]], cutoff, num_neighbors, num_layers=32, require_grad=True,
+                    compile_forward=False):
     r"""Initialize PAO models for each atomtype.
     """
     models = {}
@@ -665,6 +732,7 @@ def init_pao_models(pao_objects: Dict[KindName, List[PAO_Object]], cutoff, num_n
             irreps_input=irreps_input,
             irreps_sh=irreps_sh,
             irreps_output=irreps_output,
+            compile_forward=compile_forward,
             )
             if require_grad:
                 gradModel = GradOutput(func=models[atomtype], of="pao_vectors", wrt=["x"], out_field=["gradient"], sign=-1)
@@ -682,12 +750,12 @@ def train_model_epoch(model, optimizer, pao_objects, batch_size, batch_loss_aver
 
     batched_dicts = generate_batched_dict(pao_objects, batch_size)
     for i, data in enumerate(batched_dicts):
-        label = data.pop("y").to(model.device)
+        label_projector = data.pop("y_proj").to(model.device)
         for key, value in data.items():
             data[key] = data[key].to(model.device)
+        optimizer.zero_grad(set_to_none=True)
         data = model(data)
-        optimizer.zero_grad()
-        loss = loss_function_ortho_projector_batch(data["pao_vectors"], label)
+        loss = loss_function_projector_batch(data["pao_vectors"], label_projector)
         loss.backward()
         optimizer.step()
         running_loss += loss.item()
@@ -707,11 +775,11 @@ def validate_model(model, pao_objects, batch_size):
 
     batched_dicts = generate_batched_dict(pao_objects, batch_size)
     for i, vdata in enumerate(batched_dicts):
-        label = vdata.pop("y").to(model.device)
+        label_projector = vdata.pop("y_proj").to(model.device)
         for key, value in vdata.items():
             vdata[key] = vdata[key].to(model.device)
         vdata = model(vdata)
-        vloss = loss_function_ortho_projector_batch(vdata["pao_vectors"], label)
+        vloss = loss_function_projector_batch(vdata["pao_vectors"], label_projector)
         running_vloss += vloss.item()
 
     avg_vloss = running_vloss/(i+1)
@@ -762,6 +830,36 @@ def plot_loss(train_loss, validation_loss, atomtype):
     return
 
 
+# ======================================================================================
+def train_atomtype(atomtype, paths, test_ratio, cutoff, num_neighbors, num_epochs, batch_size, learning_rate, num_threads):
+    r"""Load the data of one atomtype, then train, plot and save its PAO model. Self-contained to run in a separate
+    process: the PAO objects and the model are created in the worker, only the file paths are sent to it.
+    """
+    torch.set_num_threads(num_threads)
+    pao_objects = pao_objects_from_paths(paths, atomtype)
+    datasets = generate_train_test_data(pao_objects, test_ratio)
+    print(f"Data for atom {atomtype} split into training and validation data with test ratio of {test_ratio:.2e}")
+    model = init_pao_models(pao_objects, cutoff, num_neighbors, num_layers=32)[atomtype]
+
+    print(f"Training Equi PAO Model for atom {atomtype} for {num_epochs} epochs.")
+    batch_loss_average = len(datasets[atomtype]["train"])//batch_size
+    optim = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    train_loss, validation_loss = train_model(
+        model,
+        optim,
+        num_epochs,
+        datasets[atomtype]["train"],
+        datasets[atomtype]["test"],
+        batch_size,
+        batch_loss_average
+        )
+    print(f"Finished training Equi PAO Model for atom {atomtype}.")
+    plot_loss(train_loss, validation_loss, atomtype)
+    save_model(model, f"pao_equi_model_{atomtype}")
+    print(f"Saved Equi PAO Model for atom {atomtype}.")
+    return train_loss, validation_loss
+
+
 # ======================================================================================
 def main():
     # TO DO: Input for training settings via seperate input file
@@ -773,11 +871,6 @@ def main():
     for path in sorted(Path().glob("training_data/*/*-1_0.pao")):
         paths.append(path)
 
-    pao_objects = pao_objects_from_paths(paths)
-    print("Generating PAO objects from provided paths.")
-    datasets = generate_train_test_data(pao_objects, 0.2)
-    print(f"Data split into training and validation data with test ratio of {test_ratio:.2e}")
-
     cutoff = 4.0
     num_neighbors= 5
     learning_rate = 1e-3
@@ -789,24 +882,26 @@ def main():
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     print(f"Training on {device}.")
 
-    models = init_pao_models(pao_objects, cutoff, num_neighbors, num_layers=32)
-    for atomtype in atomtypes:
-        print(f"Training Equi PAO Model for atom {atomtype} for {epochs[atomtype]} epochs.")
-        batch_loss_average = len(datasets[atomtype]["train"])//batch_size
-        optim = torch.optim.Adam(models[atomtype].parameters(), lr=learning_rate)
-        train_loss[atomtype], validation_loss[atomtype] = train_model(
-            models[atomtype],
-            optim,
+    # The models of the atomtypes are independent, train them concurrently with one process each
+    # (spawned, as required for CUDA in subprocesses). Each worker builds its own PAO objects and model from
+    # the paths and gets an equal share of the CPU threads.
+    num_threads = max(1, torch.get_num_threads()//len(atomtypes))
+    mp_context = torch.multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(atomtypes), mp_context=mp_context) as executor:
+        futures = {atomtype: executor.submit(
+            train_atomtype,
+            atomtype,
+            paths,
+            test_ratio,
+            cutoff,
+            num_neighbors,
             epochs[atomtype],
-            datasets[atomtype]["train"],
-            datasets[atomtype]["test"],
             batch_size,
-            batch_loss_average
-            )
-        print(f"Finished training Equi PAO Model for atom {atomtype}.")
-        plot_loss(train_loss[atomtype], validation_loss[atomtype], atomtype)
-        save_model(models[atomtype], f"pao_equi_model_{atomtype}")
-        print(f"Saved Equi PAO Model for atom {atomtype}.")
+            learning_rate,
+            num_threads
+            ) for atomtype in atomtypes}
+        for atomtype, future in futures.items():
+            train_loss[atomtype], validation_loss[atomtype] = future.result()
 
 
 if __name__ == "__main__":